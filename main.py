@@ -1,11 +1,14 @@
 import argparse
-import csv
-import collections
-import heapq
+import concurrent.futures
+import os
 import pathlib
-import functools
 
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
 
 
 _all_states: list[str] = [
@@ -17,101 +20,182 @@ _all_states: list[str] = [
     "WY",
 ]
 
+_root_dir: pathlib.Path = pathlib.Path(__file__).resolve().parent
+_data_dir: pathlib.Path = _root_dir / "data" / "namesbystate"
 
-@functools.cache
-def root_dir() -> pathlib.Path:
-    return pathlib.Path(__file__).resolve().parent.resolve()
+# Included in cache file names. Increment when the parsed data format
+# changes so that old caches are not reused.
+_cache_format: str = "v1"
 
 
-def load_state_data_(
-    state: str,
-    gender: str,
-    year_name_counts: dict[int, dict[str, int]],
-    name_year_counts: dict[str, dict[int, int]],
-) -> None:
-    data_file = root_dir() / "data" / "namesbystate" / f"{state}.TXT"
-    with open(data_file, mode="r") as f:
-        for row in csv.reader(f):
-            if row[1] != gender:
-                continue
-            year = int(row[2])
-            name = row[3].lower()
-            count = int(row[4])
-            if count <= 0:
-                continue
-            year_name_counts[year][name] += count
-            name_year_counts[name][year] += count
+def parse_state_data_file(data_file: pathlib.Path) -> pd.DataFrame:
+    column_types = {
+        "gender": pa.dictionary(pa.int32(), pa.string()),
+        "year": pa.int16(),
+        "name": pa.dictionary(pa.int32(), pa.string()),
+        "count": pa.int32(),
+    }
+    if data_file.stat().st_size == 0:
+        # pyarrow fails to read empty CSV files
+        table = pa.schema(column_types).empty_table()
+    else:
+        # Avoid Arrow's thread pool since files are parsed in parallel
+        # worker processes
+        table = pyarrow.csv.read_csv(
+            data_file,
+            read_options=pyarrow.csv.ReadOptions(
+                use_threads=False,
+                column_names=["state", "gender", "year", "name", "count"],
+            ),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types=column_types,
+                include_columns=list(column_types.keys()),
+            ),
+        )
+    table = table.filter(pc.greater(table["count"], 0))
+    data = table.to_pandas()
+
+    # Lowercase unique names rather than every row, merging any
+    # names that only differ by case
+    names = data["name"].cat
+    lower_codes, lower_names = pd.factorize(names.categories.str.lower())
+    data["name"] = pd.Categorical.from_codes(
+        lower_codes[names.codes],
+        lower_names,
+    )
+    return data
+
+
+def load_state_data(state: str, gender: str) -> pd.DataFrame:
+    data_file = _data_dir / f"{state}.TXT"
+    cache_file = _data_dir / f"{state}.{_cache_format}.parquet"
+
+    # Load parsed data from cache if it is newer than the data file
+    data = None
+    if (
+        cache_file.exists()
+        and cache_file.stat().st_mtime >= data_file.stat().st_mtime
+    ):
+        try:
+            data = pd.read_parquet(cache_file)
+        except (OSError, pa.ArrowException):
+            # Cache is unreadable, so regenerate it
+            data = None
+
+    # Parse data file and write cache. The cache is written to a
+    # temporary file first so that an interrupted run does not leave a
+    # partial cache behind. Empty data is not cached since Parquet does
+    # not preserve its categorical columns.
+    if data is None:
+        data = parse_state_data_file(data_file)
+        if len(data) > 0:
+            temp_file = cache_file.with_name(
+                f"{cache_file.name}.{os.getpid()}.tmp"
+            )
+            try:
+                data.to_parquet(temp_file, compression="zstd", index=False)
+                os.replace(temp_file, cache_file)
+            except (OSError, pa.ArrowException):
+                # Cache is optional, e.g. data directory may be read-only
+                pass
+            finally:
+                temp_file.unlink(missing_ok=True)
+
+    # Filter by gender
+    data = data[data["gender"] == gender]
+    return pd.DataFrame({
+        "year": data["year"],
+        "name": data["name"].cat.remove_unused_categories(),
+        "count": data["count"],
+    })
 
 
 def sort_year_name_counts(
-    year_name_counts: dict[int, dict[str, int]],
-) -> dict[int, dict[str, int]]:
-    year_min = min(year_name_counts.keys())
-    year_max = max(year_name_counts.keys())
-    result = collections.OrderedDict()
-    for year in range(year_min, year_max+1):
-        items = [(count, name) for name, count in year_name_counts[year].items()]
-        items.sort(reverse=True)
-        result[year] = collections.OrderedDict((name, count) for count, name in items)
-    return result
-
-
-def sort_name_year_counts(
-    name_year_counts: dict[str, dict[int, int]],
-) -> dict[str, dict[int, int]]:
-    result = {}
-    for name, year_counts in name_year_counts.items():
-        year_min = min(year_counts.keys())
-        year_max = max(year_counts.keys())
-        result[name] = collections.OrderedDict(
-            (year, year_counts[year]) for year in range(year_min, year_max+1)
-        )
-    return result
+    year_name_counts: np.ndarray,
+    top_k: int | None = None,
+) -> np.ndarray:
+    # Name indices in descending order of count, ties broken in
+    # reverse alphabetical order
+    num_names = year_name_counts.shape[1]
+    if top_k is None or top_k >= num_names:
+        return np.argsort(year_name_counts, axis=1, kind="stable")[:, ::-1]
+
+    # Only sort top-k names. Sort keys are unique so that ties at the
+    # partition boundary are resolved consistently.
+    keys = year_name_counts.astype(np.int64) * num_names + np.arange(num_names)
+    orders = np.argpartition(keys, num_names - top_k, axis=1)
+    orders = orders[:, num_names-top_k:]
+    keys = np.take_along_axis(keys, orders, axis=1)
+    return np.take_along_axis(orders, np.argsort(-keys, axis=1), axis=1)
+
+
+def rank_name_counts(
+    name_index: int,
+    year_name_counts: np.ndarray,
+) -> np.ndarray:
+    # 1-based rank of a name in each year, consistent with the order from
+    # sort_year_name_counts
+    counts = year_name_counts[:, name_index, np.newaxis]
+    num_ahead = (year_name_counts > counts).sum(axis=1)
+    num_ahead += (year_name_counts[:, name_index+1:] == counts).sum(axis=1)
+    return num_ahead + 1
+
+
+def get_name_year_counts(
+    name_index: int,
+    first_year: int,
+    year_name_counts: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    # Counts for a name between the first and last years it appears
+    counts = year_name_counts[:, name_index]
+    rows = np.flatnonzero(counts)
+    rows = slice(rows[0], rows[-1]+1)
+    years = first_year + np.arange(rows.start, rows.stop)
+    return years, counts[rows]
 
 
 def plot_trends_for_name(
     name: str,
-    year_name_counts: dict[int, dict[str, int]],
-    name_year_counts: dict[str, dict[int, int]],
-    year_total_counts: dict[int, int],
+    name_indices: dict[str, int],
+    first_year: int,
+    year_name_counts: np.ndarray,
+    year_total_counts: np.ndarray,
 ):
 
     # Check name
-    if name not in name_year_counts:
+    if name not in name_indices:
         raise RuntimeError(f"Could not find {name} in data")
+    name_index = name_indices[name]
 
     # Year bounds
-    year_min = min(name_year_counts[name].keys())
-    year_max = max(name_year_counts[name].keys())
+    years, counts = get_name_year_counts(
+        name_index,
+        first_year,
+        year_name_counts,
+    )
+    year_min = int(years[0])
+    year_max = int(years[-1])
 
     # Compute trends
-    counts = name_year_counts[name]
-    frequencies = collections.OrderedDict(
-        (year, count / year_total_counts[year])
-        for year, count in counts.items()
-    )
-    ranks = collections.OrderedDict()
-    for year in range(year_min, year_max+1):
-        if counts[year] > 0:
-            ranks[year] = next(
-                idx + 1 for idx, n in enumerate(year_name_counts[year].keys())
-                if n == name
-            )
+    rows = slice(year_min - first_year, year_max - first_year + 1)
+    frequencies = counts / year_total_counts[rows]
+    rank_mask = counts > 0
+    ranks = rank_name_counts(name_index, year_name_counts[rows])[rank_mask]
 
     # Plot
     fig, (ax1, ax2, ax3) = plt.subplots(3, 1)
     fig.suptitle(name)
-    ax1.plot(list(counts.keys()), list(counts.values()))
+    ax1.plot(years, counts)
     ax1.set_title("Total count")
     ax1.set(ylabel="Count")
     ax1.set_xlim(year_min, year_max)
     ax1.set_yscale("log")
-    ax2.plot(list(frequencies.keys()), list(frequencies.values()))
+    ax2.plot(years, frequencies)
     ax2.set_title("Frequency")
     ax2.set(ylabel="Frequency")
     ax2.set_xlim(year_min, year_max)
     ax2.set_yscale("log")
-    ax3.plot(list(ranks.keys()), list(ranks.values()))
+    ax3.plot(years[rank_mask], ranks)
     ax3.set_title("Rank")
     ax3.set(ylabel="Rank")
     ax3.set_xlim(year_min, year_max)
@@ -122,125 +206,118 @@ def plot_trends_for_name(
 def show_top_names(
     num_names: int,
     year: int,
-    year_name_counts: dict[int, dict[str, int]],
-    year_total_counts: dict[int, int],
+    names: np.ndarray,
+    first_year: int,
+    year_name_counts: np.ndarray,
+    year_total_counts: np.ndarray,
+    top_name_indices: np.ndarray,
 ) -> None:
     print("Name frequencies")
     print("----------------")
-    total_count = year_total_counts[year]
-    for idx, (name, count) in enumerate(year_name_counts[year].items()):
-        if idx >= num_names:
+    row = year - first_year
+    name_counts = year_name_counts[row]
+    total_count = year_total_counts[row]
+    for name_index in top_name_indices[:num_names]:
+        count = name_counts[name_index]
+        if count <= 0:
             break
-        print(f"{name}: {count / total_count}")
+        print(f"{names[name_index]}: {count / total_count}")
     print()
 
 
 def is_name_frequency_above_threshold(
-    name,
-    min_frequency: float,
+    name_indices: np.ndarray,
+    min_count: int,
+    min_total_count: int,
     year_min: int,
     year_max: int,
-    year_name_counts: dict[int, dict[str, int]],
-    year_total_counts: dict[int, int],
-) -> bool:
-    for year in range(year_min, year_max+1):
-        name_counts = year_name_counts[year]
-        if name not in name_counts:
-            return False
-        if name_counts[name] / year_total_counts[year] < min_frequency:
-            return False
-    return True
+    first_year: int,
+    year_name_counts: np.ndarray,
+    year_total_counts: np.ndarray,
+) -> np.ndarray:
+    # Minimum frequency is min_count / min_total_count. Convert to an
+    # exact integer count threshold for each year.
+    rows = slice(year_min - first_year, year_max - first_year + 1)
+    thresholds = -(-min_count * year_total_counts[rows] // min_total_count)
+    counts = year_name_counts[rows, name_indices]
+    return (counts >= thresholds[:, np.newaxis]).all(axis=0)
 
 
 def is_name_frequency_falling(
-    name,
+    name_indices: np.ndarray,
     year_min: int,
     year_max: int,
-    year_name_counts: dict[int, dict[str, int]],
-    year_total_counts: dict[int, int],
+    first_year: int,
+    year_name_counts: np.ndarray,
+    year_total_counts: np.ndarray,
     tolerance: float = 0.25,
-) -> bool:
+) -> np.ndarray:
     year_mid = year_min + (year_max - year_min + 2) // 2
-    name_count1 = 0
-    name_count2 = 0
-    total_count1 = 0
-    total_count2 = 0
-    for year in range(year_min, year_mid):
-        name_count1 += year_name_counts[year][name]
-        total_count1 += year_total_counts[year]
-    for year in range(year_mid, year_max+1):
-        name_count2 += year_name_counts[year][name]
-        total_count2 += year_total_counts[year]
-    frequency1 = name_count1 / total_count1
-    frequency2 = name_count2 / total_count2
-    return frequency1 > (1 + tolerance) * frequency2
+    rows1 = slice(year_min - first_year, year_mid - first_year)
+    rows2 = slice(year_mid - first_year, year_max - first_year + 1)
+    name_counts1 = year_name_counts[rows1, name_indices].sum(axis=0)
+    name_counts2 = year_name_counts[rows2, name_indices].sum(axis=0)
+    total_count1 = year_total_counts[rows1].sum()
+    total_count2 = year_total_counts[rows2].sum()
+    frequencies1 = name_counts1 / total_count1
+    frequencies2 = name_counts2 / total_count2
+    return frequencies1 > (1 + tolerance) * frequencies2
 
 
 def show_filtered_top_names(
     num_candidates: int,
     year: int,
-    year_name_counts: dict[int, dict[str, int]],
-    year_total_counts: dict[int, int],
+    names: np.ndarray,
+    first_year: int,
+    year_name_counts: np.ndarray,
+    year_total_counts: np.ndarray,
+    top_name_indices: np.ndarray,
 ) -> None:
 
-    # Candidate names
-    names = []
-    for idx, name in enumerate(year_name_counts[year].keys()):
-        if idx >= num_candidates:
-            break
-        names.append(name)
-    min_frequency = year_name_counts[year][names[-1]] / year_total_counts[year]
+    # Check year bounds
+    if year - 50 + 1 < first_year:
+        raise RuntimeError(f"Could not find 50 years of data before {year}")
 
-    # Filter function
-    def keep_name(name) -> bool:
-        if not is_name_frequency_above_threshold(
-            name,
-            min_frequency,
-            year - 50 + 1,
-            year,
-            year_name_counts,
-            year_total_counts,
-        ):
-            # Name has not maintained popularity for 50 years
-            return False
-        if is_name_frequency_falling(
-            name,
-            year - 10 + 1,
-            year,
-            year_name_counts,
-            year_total_counts,
-        ):
-            # Name frequency is falling within 10-year timeframe
-            return False
-        if is_name_frequency_falling(
-            name,
-            year - 20 + 1,
-            year,
-            year_name_counts,
-            year_total_counts,
-        ):
-            # Name frequency is falling within 20-year timeframe
-            return False
-        if is_name_frequency_falling(
-            name,
-            year - 50 + 1,
+    # Candidate names
+    row = year - first_year
+    name_indices = top_name_indices[:num_candidates]
+    name_indices = name_indices[year_name_counts[row, name_indices] > 0]
+    min_count = int(year_name_counts[row, name_indices[-1]])
+    min_total_count = int(year_total_counts[row])
+
+    # Name has maintained popularity for 50 years
+    keep = is_name_frequency_above_threshold(
+        name_indices,
+        min_count,
+        min_total_count,
+        year - 50 + 1,
+        year,
+        first_year,
+        year_name_counts,
+        year_total_counts,
+    )
+    name_indices = name_indices[keep]
+
+    # Name frequency is not falling within 10, 20, or 50-year timeframes.
+    # Names are dropped after each check so later checks see fewer names.
+    for num_years in (10, 20, 50):
+        falling = is_name_frequency_falling(
+            name_indices,
+            year - num_years + 1,
             year,
+            first_year,
             year_name_counts,
             year_total_counts,
-        ):
-            # Name frequency is falling within 50-year timeframe
-            return False
-        return True
-
-    # Apply filter
-    names = filter(keep_name, names)
+        )
+        name_indices = name_indices[~falling]
 
     # Print filtered names and frequencies
     print("Filtered name frequencies")
     print("-------------------------")
-    total_count = year_total_counts[year]
-    for name in names:
-        print(f"{name}: {year_name_counts[year][name] / total_count}")
+    total_count = year_total_counts[row]
+    for name_index in name_indices:
+        count = year_name_counts[row, name_index]
+        print(f"{names[name_index]}: {count / total_count}")
 
 
 def parse_args() -> argparse.Namespace:
@@ -265,26 +342,46 @@ def main() -> None:
     states = _all_states if args.states is None else args.states
     states = [state.upper() for state in states]
 
-    # Load name data from file
-    year_name_counts: dict[int, dict[str, int]] = collections.defaultdict(
-        lambda: collections.defaultdict(lambda: 0)
+    # Load name data from files in parallel
+    max_workers = min(len(states), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        data = list(executor.map(
+            load_state_data,
+            states,
+            [gender] * len(states),
+        ))
+
+    # Encode names as integer codes into a sorted list of names
+    name_codes = pd.api.types.union_categoricals(
+        [state_data["name"] for state_data in data if len(state_data) > 0],
+        sort_categories=True,
     )
-    name_year_counts: dict[str, dict[int, int]] = collections.defaultdict(
-        lambda: collections.defaultdict(lambda: 0)
+    names = name_codes.categories.to_numpy()
+    name_indices = {name: idx for idx, name in enumerate(names)}
+    name_codes = name_codes.codes
+    data = pd.concat(
+        [state_data[["year", "count"]] for state_data in data],
+        ignore_index=True,
     )
-    for state in states:
-        load_state_data_(state, gender, year_name_counts, name_year_counts)
+
+    # Pack name counts into matrix with shape (num_years, num_names)
+    years = data["year"].to_numpy()
+    first_year = int(years.min())
+    last_year = int(years.max())
+    shape = (last_year - first_year + 1, len(names))
+    flat_indices = (years - first_year).astype(np.intp) * shape[1] + name_codes
+    year_name_counts = np.bincount(
+        flat_indices,
+        weights=data["count"].to_numpy(),
+        minlength=shape[0] * shape[1],
+    )
+    year_name_counts = year_name_counts.astype(np.int32).reshape(shape)
+    year_total_counts = year_name_counts.sum(axis=1, dtype=np.int64)
 
     # Postprocess data
-    year_name_counts = sort_year_name_counts(year_name_counts)
-    name_year_counts = sort_name_year_counts(name_year_counts)
-    year_total_counts = {
-        year: sum(name_counts.values())
-        for year, name_counts in year_name_counts.items()
-    }
-    year_min = min(year_total_counts.keys())
-    year_max = max(year_total_counts.keys())
-    target_year = year_max if args.year is None else args.year
+    target_year = last_year if args.year is None else args.year
+    if not first_year <= target_year <= last_year:
+        raise RuntimeError(f"Could not find {target_year} in data")
 
     # Plot trends for a name
     if args.name is not None:
@@ -292,34 +389,65 @@ def main() -> None:
 
         # Print statistics
         year = target_year
-        count = year_name_counts[year].get(name, 0)
-        frequency = count / year_total_counts[year]
+        row = year - first_year
+        count = 0
         rank = -1
-        if name in year_name_counts[year]:
-            rank = next(
-                idx + 1 for idx, n in enumerate(year_name_counts[year].keys())
-                if n == name
-            )
+        if name in name_indices:
+            name_index = name_indices[name]
+            count = int(year_name_counts[row, name_index])
+            if count > 0:
+                rank = int(rank_name_counts(
+                    name_index,
+                    year_name_counts[row:row+1],
+                )[0])
+        frequency = count / year_total_counts[row]
         print(f"{year} statistics for {name}")
         print(f"Total count: {count}")
         print(f"Frequency: {frequency}")
         print(f"Rank: {rank}")
 
         # Plot trends
-        plot_trends_for_name(name, year_name_counts, name_year_counts, year_total_counts)
+        plot_trends_for_name(
+            name,
+            name_indices,
+            first_year,
+            year_name_counts,
+            year_total_counts,
+        )
         plt.show()
 
+    # Sort top names in target year
+    num_top_names = max(args.top or 0, args.filter_top or 0)
+    top_name_indices = np.empty(0, dtype=np.intp)
+    if num_top_names > 0:
+        row = target_year - first_year
+        top_name_indices = sort_year_name_counts(
+            year_name_counts[row:row+1],
+            num_top_names,
+        )[0]
+
     # Show top names
     if args.top is not None:
-        show_top_names(args.top, target_year, year_name_counts, year_total_counts)
+        show_top_names(
+            args.top,
+            target_year,
+            names,
+            first_year,
+            year_name_counts,
+            year_total_counts,
+            top_name_indices,
+        )
 
     # Show filtered top names
     if args.filter_top is not None:
         show_filtered_top_names(
             args.filter_top,
             target_year,
+            names,
+            first_year,
             year_name_counts,
             year_total_counts,
+            top_name_indices,
         )
 
 